@@ -24,10 +24,8 @@ setup(
       'aim',
       'einops',
       'contrastive_learner>=0.1.0',
-      'fire',
       'kornia>=0.5.4',
       'numpy',
-      'retry',
       'tqdm',
       'torch',
       'torchvision',
@@ -1,11 +1,16 @@
 import os
-import fire
+import sys
+import ast
+import time
 import random
-from retry.api import retry_call
+import socket
+import inspect
+import argparse
 from tqdm import tqdm
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
 from stylegan2_pytorch import Trainer, NanException
+from stylegan2_pytorch.stylegan2_pytorch import TORCH_VERSION
 
 import torch
 import torch.multiprocessing as mp
@@ -13,30 +18,103 @@ import torch.distributed as dist
 
 import numpy as np
 
-def cast_list(el):
-    return el if isinstance(el, list) else [el]
+LOG_INTERVAL = 10.
+NAN_TRIES = 3
+
+NON_MODEL_ARGS = (
+    'data',
+    'new',
+    'load_from',
+    'disc_load_from',
+    'learning_rate',
+    'num_train_steps',
+    'generate',
+    'num_generate',
+    'generate_interpolation',
+    'interpolation_num_steps',
+    'save_frames',
+    'multi_gpus',
+    'seed',
+    'deterministic'
+)
+
+def as_tuple(el):
+    if isinstance(el, str):
+        return tuple(part.strip() for part in el.split(',') if part.strip())
+    return tuple(el) if isinstance(el, (list, tuple)) else (el,)
+
+def parse_bool(value):
+    if value.lower() in ('true', 't', 'yes', 'y', '1'):
+        return True
+    if value.lower() in ('false', 'f', 'no', 'n', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f'expected a boolean, got {value}')
+
+def parse_literal(value):
+    # like fire, bare words inside `[a,b]` or `a,b` are read as strings
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+
+    if value.startswith('[') and value.endswith(']'):
+        return [parse_literal(el.strip()) for el in value[1:-1].split(',') if el.strip()]
+    if ',' in value:
+        return tuple(parse_literal(el.strip()) for el in value.split(',') if el.strip())
+    return value
 
 def timestamped_filename(prefix = 'generated-'):
     now = datetime.now()
     timestamp = now.strftime("%m-%d-%Y_%H-%M-%S")
     return f'{prefix}{timestamp}'
 
-def set_seed(seed):
+def set_seed(seed, rank = 0):
+    # ddp broadcasts rank 0's weights, so only the sampling differs per rank
+    seed = seed + rank
     torch.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    torch.cuda.manual_seed_all(seed)
     np.random.seed(seed)
     random.seed(seed)
 
-def run_training(rank, world_size, model_args, data, load_from, disc_load_from, new, num_train_steps, name, seed):
+def is_launched_worker():
+    return 'LOCAL_RANK' in os.environ
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def spawn_worker(rank, world_size, master_port, *args):
+    # give each spawned worker the same environment torchrun would
+    os.environ.update(
+        RANK = str(rank),
+        LOCAL_RANK = str(rank),
+        WORLD_SIZE = str(world_size),
+        MASTER_ADDR = 'localhost',
+        MASTER_PORT = str(master_port)
+    )
+    run_training(*args)
+
+def run_training(model_args, data, load_from, disc_load_from, new, num_train_steps, name, seed, deterministic):
+    # only set when started by torchrun or spawn_worker
+    is_worker = is_launched_worker()
+    rank = int(os.environ['RANK']) if is_worker else 0
+    world_size = int(os.environ['WORLD_SIZE']) if is_worker else 1
+
     is_main = rank == 0
     is_ddp = world_size > 1
 
+    # must precede the first cuda allocation
+    if TORCH_VERSION >= (2, 1):
+        os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
+    set_seed(seed, rank)
+
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
+
     if is_ddp:
-        set_seed(seed)
-        os.environ['MASTER_ADDR'] = 'localhost'
-        os.environ['MASTER_PORT'] = '12355'
-        dist.init_process_group('nccl', rank=rank, world_size=world_size)
+        dist.init_process_group('nccl', init_method='env://', rank=rank, world_size=world_size, timeout=timedelta(minutes=30))
 
         print(f"{rank + 1}/{world_size} process initialized.")
 
@@ -61,18 +139,62 @@ def run_training(rank, world_size, model_args, data, load_from, disc_load_from,
 
     model.set_data_src(data)
 
-    progress_bar = tqdm(initial = model.steps, total = num_train_steps, mininterval=10., desc=f'{name}<{data}>')
-    while model.steps < num_train_steps:
-        retry_call(model.train, tries=3, exceptions=NanException)
-        progress_bar.n = model.steps
-        progress_bar.refresh()
-        if is_main and model.steps % 50 == 0:
-            model.print_log()
+    progress_bar = None
 
-    model.save(model.checkpoint_num)
+    try:
+        if model.steps < num_train_steps:
+            model.warmup()
+            torch.cuda.synchronize()
 
-    if is_ddp:
-        dist.destroy_process_group()
+        progress_bar = tqdm(initial = model.steps, total = num_train_steps, mininterval=10., desc=f'{name}<{data}>', disable = not is_main)
+        last_steps = model.steps
+        last_log_time = time.monotonic()
+        nan_failures = 0
+
+        while model.steps < num_train_steps:
+            try:
+                model.train()
+            except NanException:
+                nan_failures += 1
+                if nan_failures >= NAN_TRIES:
+                    raise
+
+                # nothing is saved yet at step 0, fall back to the latest checkpoint
+                checkpoint_num = model.checkpoint_num
+                if not os.path.exists(model.model_name(checkpoint_num)):
+                    checkpoint_num = -1
+
+                if is_main:
+                    print(f'NaN during training, restarting from checkpoint #{checkpoint_num} ({nan_failures}/{NAN_TRIES})')
+
+                model.load(checkpoint_num)
+                continue
+
+            nan_failures = 0
+
+            if is_main:
+                progress_bar.update(model.steps - last_steps)
+                last_steps = model.steps
+
+            if is_main and model.steps % 50 == 0 and time.monotonic() - last_log_time >= LOG_INTERVAL:
+                model.print_log()
+                last_log_time = time.monotonic()
+
+        if is_main:
+            model.save(model.checkpoint_num)
+            model.wait_for_save_callback()
+    finally:
+        if progress_bar is not None:
+            progress_bar.close()
+
+        if model.save_callback_executor is not None:
+            model.save_callback_executor.shutdown(wait = True)
+
+        if is_ddp:
+            dist.destroy_process_group()
+
+        del model
+        torch.cuda.empty_cache()
 
 def train_from_folder(
     data = './data',
@@ -127,6 +249,7 @@ def train_from_folder(
     calculate_fid_num_images = 12800,
     clear_fid_cache = False,
     seed = 42,
+    deterministic = False,
     log = False,
     lookahead=True,
     lookahead_alpha=0.5,
@@ -134,53 +257,13 @@ def train_from_folder(
     ema_beta = 0.9999,
     augment_saved_with_disc_loss = False
 ):
-    model_args = dict(
-        name = name,
-        base_dir = base_dir,
-        results_dir = results_dir,
-        models_dir = models_dir,
-        batch_size = batch_size,
-        gradient_accumulate_every = gradient_accumulate_every,
-        image_size = image_size,
-        network_capacity = network_capacity,
-        fmap_max = fmap_max,
-        transparent = transparent,
+    model_args = dict(locals())
+    for key in NON_MODEL_ARGS:
+        model_args.pop(key)
+
+    model_args.update(
         lr = learning_rate,
-        lr_mlp = lr_mlp,
-        ttur_mult = ttur_mult,
-        rel_disc_loss = rel_disc_loss,
-        num_workers = num_workers,
-        save_every = save_every,
-        save_callback = save_callback,
-        evaluate_every = evaluate_every,
-        evaluate_callback = evaluate_callback,
-        num_image_tiles = num_image_tiles,
-        trunc_psi = trunc_psi,
-        fp16 = fp16,
-        no_pl_reg = no_pl_reg,
-        cl_reg = cl_reg,
-        fq_layers = fq_layers,
-        fq_dict_size = fq_dict_size,
-        attn_layers = attn_layers,
-        no_const = no_const,
-        aug_prob = aug_prob,
-        aug_types = cast_list(aug_types),
-        top_k_training = top_k_training,
-        generator_top_k_gamma = generator_top_k_gamma,
-        generator_top_k_frac = generator_top_k_frac,
-        dual_contrast_loss = dual_contrast_loss,
-        dataset_aug_prob = dataset_aug_prob,
-        calculate_fid_every = calculate_fid_every,
-        calculate_fid_batch_size = calculate_fid_batch_size,
-        calculate_fid_num_images = calculate_fid_num_images,
-        clear_fid_cache = clear_fid_cache,
-        mixed_prob = mixed_prob,
-        log = log,
-        lookahead = lookahead,
-        lookahead_alpha = lookahead_alpha,
-        lookahead_k = lookahead_k,
-        ema_beta = ema_beta,
-        augment_saved_with_disc_loss = augment_saved_with_disc_loss
+        aug_types = as_tuple(aug_types)
     )
 
     if generate:
@@ -200,16 +283,48 @@ def train_from_folder(
         print(f'interpolation generated at {results_dir}/{name}/{samples_name}')
         return
 
-    world_size = torch.cuda.device_count()
+    world_size = torch.cuda.device_count() if multi_gpus and not is_launched_worker() else 1
 
-    if world_size == 1 or not multi_gpus:
-        run_training(0, 1, model_args, data, load_from, disc_load_from, new, num_train_steps, name, seed)
+    if world_size == 1:
+        run_training(model_args, data, load_from, disc_load_from, new, num_train_steps, name, seed, deterministic)
         return
 
-    mp.spawn(run_training,
-        args=(world_size, model_args, data, load_from, disc_load_from, new, num_train_steps, name, seed),
+    # called from python, so spawn the workers in process
+    mp.spawn(spawn_worker,
+        args=(world_size, find_free_port(), model_args, data, load_from, disc_load_from, new, num_train_steps, name, seed, deterministic),
         nprocs=world_size,
         join=True)
 
+NON_CLI_ARGS = ('save_callback', 'evaluate_callback')
+
+def cli_parser():
+    parser = argparse.ArgumentParser(prog = 'stylegan2_pytorch', description = 'Train or sample from a StyleGAN2 model', allow_abbrev = False)
+
+    for name, param in inspect.signature(train_from_folder).parameters.items():
+        if name in NON_CLI_ARGS:
+            continue
+
+        default = param.default
+        flags = dict.fromkeys([f'--{name.replace("_", "-")}', f'--{name}'])
+
+        if isinstance(default, bool):
+            parser.add_argument(*flags, dest = name, default = default, type = parse_bool, nargs = '?', const = True)
+        elif isinstance(default, str):
+            parser.add_argument(*flags, dest = name, default = default, type = str)
+        else:
+            parser.add_argument(*flags, dest = name, default = default, type = parse_literal)
+
+    return parser
+
 def main():
-    fire.Fire(train_from_folder)
+    args = cli_parser().parse_args()
+
+    is_training = not (args.generate or args.generate_interpolation)
+    world_size = torch.cuda.device_count() if args.multi_gpus and is_training and not is_launched_worker() else 1
+
+    if world_size > 1:
+        # relaunch under torchrun, one worker per gpu
+        torchrun_args = ['-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={world_size}']
+        os.execv(sys.executable, [sys.executable, *torchrun_args, sys.argv[0], *sys.argv[1:]])
+
+    train_from_folder(**vars(args))
@@ -1,7 +1,7 @@
 import os
+import re
 import sys
 import math
-import fire
 import json
 
 from collections import defaultdict
@@ -12,6 +12,7 @@ from shutil import rmtree
 from functools import partial
 import multiprocessing
 from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -30,7 +31,7 @@ from kornia.filters import filter2d
 import torchvision
 from torchvision import transforms
 from stylegan2_pytorch.version import __version__
-from stylegan2_pytorch.diff_augment import DiffAugment
+from stylegan2_pytorch.diff_augment import DiffAugment, AUGMENT_FNS
 
 from vector_quantize_pytorch import VectorQuantize
 
@@ -52,6 +53,12 @@ assert torch.cuda.is_available(), 'You need to have an Nvidia GPU with CUDA inst
 
 NUM_CORES = multiprocessing.cpu_count()
 EXTS = ['jpg', 'jpeg', 'png']
+MODEL_FILE_RE = re.compile(r'^model_(\d+)\.pt$')
+
+TORCH_VERSION = tuple(map(int, torch.__version__.split('.')[:2]))
+
+# checkpoints only hold tensors and plain python values
+TORCH_LOAD_KWARGS = dict(weights_only = True) if TORCH_VERSION >= (1, 13) else dict()
 
 # helper classes
 
@@ -216,7 +223,7 @@ def raise_if_nan(t):
 def gradient_accumulate_contexts(gradient_accumulate_every, is_ddp, ddps):
     if is_ddp:
         num_no_syncs = gradient_accumulate_every - 1
-        head = [combine_contexts(map(lambda ddp: ddp.no_sync, ddps))] * num_no_syncs
+        head = [combine_contexts([ddp.no_sync for ddp in ddps])] * num_no_syncs
         tail = [null_context]
         contexts =  head + tail
     else:
@@ -874,6 +881,8 @@ class Trainer():
 
         self.aug_prob = aug_prob
         self.aug_types = aug_types
+        unknown_aug_types = [t for t in aug_types if t not in AUGMENT_FNS]
+        assert len(unknown_aug_types) == 0, f'unknown augmentation types {unknown_aug_types}, choose from {list(AUGMENT_FNS.keys())}'
 
         self.lr = lr
         self.lr_mlp = lr_mlp
@@ -888,6 +897,8 @@ class Trainer():
         self.evaluate_callback = evaluate_callback
         self.save_every = save_every
         self.save_callback = save_callback
+        self.save_callback_executor = ThreadPoolExecutor(max_workers = 1) if exists(save_callback) else None
+        self.pending_save_callback = None
         self.steps = 0
 
         self.av = None
@@ -1006,6 +1017,132 @@ class Trainer():
             self.aug_prob = min(0.5, (1e5 - num_samples) * 3e-6)
             print(f'autosetting augmentation probability to {round(self.aug_prob * 100)}%')
 
+    def training_modules(self):
+        if not self.is_ddp:
+            return self.GAN.S, self.GAN.G, self.GAN.D_aug
+        return self.S_ddp, self.G_ddp, self.D_aug_ddp
+
+    def loss_fns(self):
+        if not self.dual_contrast_loss:
+            return hinge_loss, gen_hinge_loss, False
+        return dual_contrastive_loss, dual_contrastive_loss, True
+
+    def discriminator_loss(self, S, G, D_aug, get_latents_fn, D_loss_fn, aug_kwargs, apply_gradient_penalty):
+        batch_size = math.ceil(self.batch_size / self.world_size)
+
+        image_size = self.GAN.G.image_size
+        latent_dim = self.GAN.G.latent_dim
+        num_layers = self.GAN.G.num_layers
+
+        style = get_latents_fn(batch_size, num_layers, latent_dim, device=self.rank)
+        noise = image_noise(batch_size, image_size, device=self.rank)
+
+        w_space = latent_to_w(S, style)
+        w_styles = styles_def_to_tensor(w_space)
+
+        generated_images = G(w_styles, noise)
+        fake_output, fake_q_loss = D_aug(generated_images.clone().detach(), detach = True, **aug_kwargs)
+
+        image_batch = next(self.loader).cuda(self.rank)
+        image_batch.requires_grad_()
+        real_output, real_q_loss = D_aug(image_batch, **aug_kwargs)
+
+        real_output_loss = real_output
+        fake_output_loss = fake_output
+
+        if self.rel_disc_loss:
+            real_output_loss = real_output_loss - fake_output.mean()
+            fake_output_loss = fake_output_loss - real_output.mean()
+
+        divergence = D_loss_fn(real_output_loss, fake_output_loss)
+        disc_loss = divergence
+
+        if self.has_fq:
+            quantize_loss = (fake_q_loss + real_q_loss).mean()
+            self.q_loss = float(quantize_loss.detach().item())
+
+            disc_loss = disc_loss + quantize_loss
+
+        if apply_gradient_penalty:
+            gp = gradient_penalty(image_batch, real_output)
+            self.last_gp_loss = gp.clone().detach().item()
+            disc_loss = disc_loss + gp
+
+        return disc_loss, divergence
+
+    def generator_loss(self, S, G, D_aug, get_latents_fn, G_loss_fn, G_requires_reals, aug_kwargs, apply_path_penalty):
+        batch_size = math.ceil(self.batch_size / self.world_size)
+
+        image_size = self.GAN.G.image_size
+        latent_dim = self.GAN.G.latent_dim
+        num_layers = self.GAN.G.num_layers
+
+        style = get_latents_fn(batch_size, num_layers, latent_dim, device=self.rank)
+        noise = image_noise(batch_size, image_size, device=self.rank)
+
+        w_space = latent_to_w(S, style)
+        w_styles = styles_def_to_tensor(w_space)
+
+        generated_images = G(w_styles, noise)
+        fake_output, _ = D_aug(generated_images, **aug_kwargs)
+        fake_output_loss = fake_output
+
+        real_output = None
+        if G_requires_reals:
+            image_batch = next(self.loader).cuda(self.rank)
+            real_output, _ = D_aug(image_batch, detach = True, **aug_kwargs)
+            real_output = real_output.detach()
+
+        if self.top_k_training:
+            epochs = (self.steps * batch_size * self.gradient_accumulate_every) / len(self.dataset)
+            k_frac = max(self.generator_top_k_gamma ** epochs, self.generator_top_k_frac)
+            k = math.ceil(batch_size * k_frac)
+
+            if k != batch_size:
+                fake_output_loss, _ = fake_output_loss.topk(k=k, largest=False)
+
+        loss = G_loss_fn(fake_output_loss, real_output)
+        gen_loss = loss
+
+        avg_pl_length = None
+        if apply_path_penalty:
+            pl_lengths = calc_pl_lengths(w_styles, generated_images)
+            avg_pl_length = np.mean(pl_lengths.detach().cpu().numpy())
+
+            if not is_empty(self.pl_mean):
+                pl_loss = ((pl_lengths - self.pl_mean) ** 2).mean()
+                if not torch.isnan(pl_loss):
+                    gen_loss = gen_loss + pl_loss
+
+        return gen_loss, loss, avg_pl_length
+
+    def warmup(self):
+        # one discarded discriminator and generator pass, gradient penalty included, so cudnn autotuning,
+        # allocator growth and dataloader worker startup happen before the first real training step
+        assert exists(self.loader), 'You must first initialize the data source with `.set_data_src(<folder of images>)`'
+
+        if not exists(self.GAN):
+            self.init_GAN()
+
+        self.GAN.train()
+
+        S, G, D_aug = self.training_modules()
+        D_loss_fn, G_loss_fn, G_requires_reals = self.loss_fns()
+        aug_kwargs = {'prob': self.aug_prob, 'types': self.aug_types}
+        backwards = partial(loss_backwards, self.fp16)
+
+        last_gp_loss, q_loss = self.last_gp_loss, self.q_loss
+
+        disc_loss, _ = self.discriminator_loss(S, G, D_aug, noise_list, D_loss_fn, aug_kwargs, apply_gradient_penalty = True)
+        backwards(disc_loss, self.GAN.D_opt, loss_id = 1)
+
+        gen_loss, _, _ = self.generator_loss(S, G, D_aug, noise_list, G_loss_fn, G_requires_reals, aug_kwargs, apply_path_penalty = False)
+        backwards(gen_loss, self.GAN.G_opt, loss_id = 2)
+
+        self.GAN.D_opt.zero_grad()
+        self.GAN.G_opt.zero_grad()
+        self.last_gp_loss, self.q_loss = last_gp_loss, q_loss
+
     def train(self):
         assert exists(self.loader), 'You must first initialize the data source with `.set_data_src(<folder of images>)`'
 
@@ -1030,10 +1167,7 @@ class Trainer():
         apply_path_penalty = not self.no_pl_reg and self.steps > 5000 and self.steps % 32 == 0
         apply_cl_reg_to_generated = self.steps > 20000
 
-        S = self.GAN.S if not self.is_ddp else self.S_ddp
-        G = self.GAN.G if not self.is_ddp else self.G_ddp
-        D = self.GAN.D if not self.is_ddp else self.D_ddp
-        D_aug = self.GAN.D_aug if not self.is_ddp else self.D_aug_ddp
+        S, G, D_aug = self.training_modules()
 
         backwards = partial(loss_backwards, self.fp16)
 
@@ -1064,14 +1198,7 @@ class Trainer():
 
         # setup losses
 
-        if not self.dual_contrast_loss:
-            D_loss_fn = hinge_loss
-            G_loss_fn = gen_hinge_loss
-            G_requires_reals = False
-        else:
-            D_loss_fn = dual_contrastive_loss
-            G_loss_fn = dual_contrastive_loss
-            G_requires_reals = True
+        D_loss_fn, G_loss_fn, G_requires_reals = self.loss_fns()
 
         # train discriminator
 
@@ -1080,40 +1207,10 @@ class Trainer():
 
         for i in gradient_accumulate_contexts(self.gradient_accumulate_every, self.is_ddp, ddps=[D_aug, S, G]):
             get_latents_fn = mixed_list if random() < self.mixed_prob else noise_list
-            style = get_latents_fn(batch_size, num_layers, latent_dim, device=self.rank)
-            noise = image_noise(batch_size, image_size, device=self.rank)
-
-            w_space = latent_to_w(S, style)
-            w_styles = styles_def_to_tensor(w_space)
-
-            generated_images = G(w_styles, noise)
-            fake_output, fake_q_loss = D_aug(generated_images.clone().detach(), detach = True, **aug_kwargs)
-
-            image_batch = next(self.loader).cuda(self.rank)
-            image_batch.requires_grad_()
-            real_output, real_q_loss = D_aug(image_batch, **aug_kwargs)
-
-            real_output_loss = real_output
-            fake_output_loss = fake_output
-
-            if self.rel_disc_loss:
-                real_output_loss = real_output_loss - fake_output.mean()
-                fake_output_loss = fake_output_loss - real_output.mean()
-
-            divergence = D_loss_fn(real_output_loss, fake_output_loss)
-            disc_loss = divergence
-
-            if self.has_fq:
-                quantize_loss = (fake_q_loss + real_q_loss).mean()
-                self.q_loss = float(quantize_loss.detach().item())
-
-                disc_loss = disc_loss + quantize_loss
+            disc_loss, divergence = self.discriminator_loss(S, G, D_aug, get_latents_fn, D_loss_fn, aug_kwargs, apply_gradient_penalty)
 
             if apply_gradient_penalty:
-                gp = gradient_penalty(image_batch, real_output)
-                self.last_gp_loss = gp.clone().detach().item()
                 self.track(self.last_gp_loss, 'GP')
-                disc_loss = disc_loss + gp
 
             disc_loss = disc_loss / self.gradient_accumulate_every
             disc_loss.register_hook(raise_if_nan)
@@ -1131,41 +1228,10 @@ class Trainer():
         self.GAN.G_opt.zero_grad()
 
         for i in gradient_accumulate_contexts(self.gradient_accumulate_every, self.is_ddp, ddps=[S, G, D_aug]):
-            style = get_latents_fn(batch_size, num_layers, latent_dim, device=self.rank)
-            noise = image_noise(batch_size, image_size, device=self.rank)
-
-            w_space = latent_to_w(S, style)
-            w_styles = styles_def_to_tensor(w_space)
-
-            generated_images = G(w_styles, noise)
-            fake_output, _ = D_aug(generated_images, **aug_kwargs)
-            fake_output_loss = fake_output
-
-            real_output = None
-            if G_requires_reals:
-                image_batch = next(self.loader).cuda(self.rank)
-                real_output, _ = D_aug(image_batch, detach = True, **aug_kwargs)
-                real_output = real_output.detach()
-
-            if self.top_k_training:
-                epochs = (self.steps * batch_size * self.gradient_accumulate_every) / len(self.dataset)
-                k_frac = max(self.generator_top_k_gamma ** epochs, self.generator_top_k_frac)
-                k = math.ceil(batch_size * k_frac)
-
-                if k != batch_size:
-                    fake_output_loss, _ = fake_output_loss.topk(k=k, largest=False)
-
-            loss = G_loss_fn(fake_output_loss, real_output)
-            gen_loss = loss
+            gen_loss, loss, pl_length = self.generator_loss(S, G, D_aug, get_latents_fn, G_loss_fn, G_requires_reals, aug_kwargs, apply_path_penalty)
 
             if apply_path_penalty:
-                pl_lengths = calc_pl_lengths(w_styles, generated_images)
-                avg_pl_length = np.mean(pl_lengths.detach().cpu().numpy())
-
-                if not is_empty(self.pl_mean):
-                    pl_loss = ((pl_lengths - self.pl_mean) ** 2).mean()
-                    if not torch.isnan(pl_loss):
-                        gen_loss = gen_loss + pl_loss
+                avg_pl_length = pl_length
 
             gen_loss = gen_loss / self.gradient_accumulate_every
             gen_loss.register_hook(raise_if_nan)
@@ -1464,19 +1530,33 @@ class Trainer():
         if self.GAN.fp16:
             save_data['amp'] = amp.state_dict()
 
-        torch.save(save_data, self.model_name(num))
+        # write to a temporary file first, so a callback still reading the previous checkpoint never sees a partial file
+        model_path = self.model_name(num)
+        incomplete_path = f'{model_path}.incomplete'
+        torch.save(save_data, incomplete_path)
+
+        self.wait_for_save_callback()
+        os.replace(incomplete_path, model_path)
         self.write_config()
 
-        if self.save_callback is not None:
-            self.save_callback(self.model_name(num))
+        if exists(self.save_callback):
+            self.pending_save_callback = self.save_callback_executor.submit(self.save_callback, model_path)
+
+    def wait_for_save_callback(self):
+        # at most one save callback is in flight, any exception it raised surfaces here
+        if not exists(self.pending_save_callback):
+            return
+        pending, self.pending_save_callback = self.pending_save_callback, None
+        pending.result()
 
     def load(self, num = -1):
         self.load_config()
 
         name = num
         if num == -1:
-            file_paths = [p for p in Path(self.models_dir / self.name).glob('model_*.pt')]
-            saved_nums = sorted(map(lambda x: int(x.stem.split('_')[1]), file_paths))
+            with os.scandir(self.models_dir / self.name) as entries:
+                matches = filter(exists, (MODEL_FILE_RE.match(entry.name) for entry in entries))
+                saved_nums = sorted(int(m.group(1)) for m in matches)
             if len(saved_nums) == 0:
                 return
             name = saved_nums[-1]
@@ -1484,7 +1564,7 @@ class Trainer():
 
         self.steps = name * self.save_every
 
-        load_data = torch.load(self.model_name(name))
+        load_data = torch.load(self.model_name(name), **TORCH_LOAD_KWARGS)
 
         if 'version' in load_data:
             print(f"loading from version {load_data['version']}")